@@ -105,8 +105,15 @@ if __name__ == '__main__':
                         help="where to save the log information")
     parser.add_argument("--log_lvl", default="i", type=str,
                         help="d=DEBUG; i=INFO; w=WARNING; e=ERROR")
+    parser.add_argument('--use_dynamic_padding', action='store_true',
+                        help="Whether to pad each batch to its longest example instead of max_seq_length "
+                             "(training batches are also grouped by length)")
+    parser.add_argument('--use_torch_compile', action='store_true',
+                        help="Whether to compile the model with torch.compile (require torch>=2.0)")
     parser.add_argument("--num_core", default=1, type=int,
                         help="how many cores used for multiple process for data generation")
+    parser.add_argument("--num_workers", default=2, type=int,
+                        help="how many worker processes the data loaders use to prepare batches; 0 for main process")
     parser.add_argument("--non_relation_label", default="NonRel", type=str,
                         help="The label used for representing "
                              "candidate entity pairs that is not a true relation (negative sample)")
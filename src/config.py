@@ -1,6 +1,6 @@
-from transformers import (BertConfig, RobertaConfig, XLNetConfig, AlbertConfig, LongformerConfig,
-                          BertTokenizer, RobertaTokenizer, XLNetTokenizer, AlbertTokenizer, LongformerTokenizer,
-                          DebertaConfig, DebertaTokenizer)
+from transformers import (BertConfig, RobertaConfig, XLNetConfig, AlbertConfig, LongformerConfig, DebertaConfig,
+                          BertTokenizerFast, RobertaTokenizerFast, XLNetTokenizerFast, AlbertTokenizerFast,
+                          LongformerTokenizerFast, DebertaTokenizerFast)
 from models import (BertForRelationIdentification, RoBERTaForRelationIdentification,
                     XLNetForRelationIdentification, AlbertForRelationIdentification,
                     LongFormerForRelationIdentification, DebertaForRelationIdentification)
@@ -15,13 +15,14 @@ SPEC_TAGS = [EN1_START, EN1_END, EN2_START, EN2_END]
 
 MODEL_REQUIRE_SEGMENT_ID = {'bert', 'xlnet', 'albert', 'deberta'}
 
+# fast (Rust) tokenizers encode a batch of texts in parallel threads
 MODEL_DICT = {
-    "bert": (BertForRelationIdentification, BertConfig, BertTokenizer),
-    "roberta": (RoBERTaForRelationIdentification, RobertaConfig, RobertaTokenizer),
-    "xlnet": (XLNetForRelationIdentification, XLNetConfig, XLNetTokenizer),
-    "albert": (AlbertForRelationIdentification, AlbertConfig, AlbertTokenizer),
-    "longformer": (LongFormerForRelationIdentification, LongformerConfig, LongformerTokenizer),
-    "deberta": (DebertaForRelationIdentification, DebertaConfig, DebertaTokenizer)
+    "bert": (BertForRelationIdentification, BertConfig, BertTokenizerFast),
+    "roberta": (RoBERTaForRelationIdentification, RobertaConfig, RobertaTokenizerFast),
+    "xlnet": (XLNetForRelationIdentification, XLNetConfig, XLNetTokenizerFast),
+    "albert": (AlbertForRelationIdentification, AlbertConfig, AlbertTokenizerFast),
+    "longformer": (LongFormerForRelationIdentification, LongformerConfig, LongformerTokenizerFast),
+    "deberta": (DebertaForRelationIdentification, DebertaConfig, DebertaTokenizerFast)
 }
 
 TOKENIZER_USE_FOUR_SPECIAL_TOKs = {'roberta', 'longformer'}
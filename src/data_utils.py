@@ -1,10 +1,11 @@
 import traceback
+import logging
 from config import MODEL_REQUIRE_SEGMENT_ID, SPEC_TAGS, TOKENIZER_USE_FOUR_SPECIAL_TOKs
 import csv
 from pathlib import Path
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
-import re
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset, Sampler
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 from functools import partial
 from concurrent.futures import ProcessPoolExecutor
@@ -12,10 +13,14 @@ import numpy as np
 from collections import Counter
 
 
+# set for O(1) special tag lookup when scanning words (SPEC_TAGS itself is a list to keep the tag order)
+SPEC_TAG_SET = frozenset(SPEC_TAGS)
+
+
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
 
-    def __init__(self, guid, text_a, text_b=None, label=None):
+    def __init__(self, guid, text_a, text_b=None, label=None, encoding=None):
         """Constructs a InputExample.
 
         Args:
@@ -26,11 +31,15 @@ class InputExample(object):
             Only must be specified for sequence pair tasks.
             label: (Optional) string. The label of the example. This should be
             specified for train and dev examples, but not for test examples.
+            encoding: (Optional) dict. The tokenizer output (input_ids etc. as numpy arrays padded to
+            max_seq_len) of text_a and text_b if already computed by the data processor, so the texts do not
+            need to be tokenized again.
         """
         self.guid = guid
         self.text_a = text_a
         self.text_b = text_b
         self.label = label
+        self.encoding = encoding
 
     def __str__(self):
         s = ""
@@ -40,7 +49,7 @@ class InputExample(object):
 
 
 class InputFeatures(object):
-    """A single set of features of data."""
+    """A set of features of data; each attribute holds one row per example."""
 
     def __init__(self, input_ids, attention_mask=None, token_type_ids=None, label=None):
         self.input_ids = input_ids
@@ -48,6 +57,9 @@ class InputFeatures(object):
         self.token_type_ids = token_type_ids
         self.label = label
 
+    def __len__(self):
+        return len(self.input_ids)
+
     def __str__(self):
         s = ""
         for k, v in self.__dict__.items():
@@ -56,96 +68,254 @@ class InputFeatures(object):
 
 
 def convert_examples_to_relation_extraction_features(
-        examples, label2idx, tokenizer, max_length=128):
-    """This function is the same as transformers.glue_convert_examples_to_features"""
-    features = []
+        examples, label2idx, tokenizer, max_length=128, logger=None):
+    """
+        encode all examples with one batched tokenizer call
+        (or only stack the rows if the data processor already encoded every example padded to max_length)
+        return a single InputFeatures holding (num_examples, max_length) numpy arrays
+    """
+    if examples and all(example.encoding is not None and len(example.encoding['input_ids']) == max_length
+                        for example in examples):
+        inputs = {key: np.stack([example.encoding[key] for example in examples]) for key in examples[0].encoding}
+    else:
+        texts_a = [example.text_a for example in examples]
+        num_text_b = sum(bool(example.text_b) for example in examples)
+        if 0 < num_text_b < len(examples):
+            # one batched call encodes either all pairs or all single texts; never drop text_b silently
+            raise ValueError("text_b is set for {} of {} examples; expect all sentence pairs or all single texts"
+                             .format(num_text_b, len(examples)))
+        texts_b = [example.text_b for example in examples] if num_text_b else None
+        inputs = tokenizer(texts_a, texts_b, padding='max_length', truncation=True,
+                           max_length=max_length, return_tensors='np')
+    labels = np.fromiter((label2idx[example.label] for example in examples), dtype=np.int64, count=len(examples))
+
+    features = InputFeatures(input_ids=inputs['input_ids'],
+                             attention_mask=inputs['attention_mask'],
+                             token_type_ids=inputs.get('token_type_ids', None),
+                             label=labels)
+
+    if logger and logger.isEnabledFor(logging.DEBUG):
+        for idx, example in enumerate(examples[:3]):
+            logger.debug("###exampel###\nguide: {}\ntext: {}\ntoken ids: {}\nmasks: {}\nlabel: {}\n########".format(
+                example.guid,
+                example.text_a + " " + example.text_b if example.text_b else example.text_a,
+                features.input_ids[idx].tolist(),
+                features.attention_mask[idx].tolist(),
+                features.label[idx]))
 
-    for idx, example in enumerate(tqdm(examples)):
-        text_a, text_b = example.text_a, example.text_b
+    return features
 
-        tokens_a = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text_a))
 
-        if text_b:
-            tokens_b = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text_b))
-        else:
-            tokens_b = None
+FEATURE_FIELDS = ("input_ids", "attention_mask", "token_type_ids", "label")
+# empty file created after all the feature arrays are saved; a cache dir without it is incomplete
+CACHE_COMPLETE_MARKER = "complete"
 
-        inputs = tokenizer.encode_plus(
-            tokens_a, tokens_b, pad_to_max_length=True, max_length=max_length, truncation=False)
 
-        label = label2idx[example.label]
-        feature = InputFeatures(**inputs, label=label)
-        features.append(feature)
+def save_features(features, cache_dir):
+    """save each feature array as a .npy file under cache_dir, then mark the cache complete"""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    marker = cache_dir / CACHE_COMPLETE_MARKER
+    if marker.exists():
+        marker.unlink()
+    for field in FEATURE_FIELDS:
+        arr = getattr(features, field)
+        if arr is not None:
+            np.save(cache_dir / "{}.npy".format(field), arr)
+    marker.touch()
 
-        if idx < 3:
-            print("###exampel###\nguide: {}\ntext: {}\ntoken ids: {}\nmasks: {}\nlabel: {}\n########".format(
-                example.guid,
-                example.text_a + " " + example.text_b,
-                feature.input_ids,
-                feature.attention_mask,
-                feature.label))
 
-    return features
+def has_cached_features(cache_dir):
+    return (Path(cache_dir) / CACHE_COMPLETE_MARKER).exists()
+
+
+def load_features(cache_dir):
+    """
+        memory map the feature arrays saved by save_features; pages are read on demand
+        copy-on-write mode keeps the arrays writable so torch.from_numpy can share them without a copy
+    """
+    cache_dir = Path(cache_dir)
+    arrays = dict()
+    for field in FEATURE_FIELDS:
+        arr_file = cache_dir / "{}.npy".format(field)
+        arrays[field] = np.load(arr_file, mmap_mode="c") if arr_file.exists() else None
+
+    return InputFeatures(**arrays)
 
 
 def features2tensors(features, binary_mode=False, logger=None):
-    tensor_input_ids = []
-    tensor_attention_masks = []
-    tensor_token_type_ids = []
-    tensor_label_ids = []
-
-    for idx, feature in enumerate(features):
-        if logger and idx < 3:
-            logger.info("Feature{}:\n{}\n".format(idx + 1, feature))
-
-        tensor_input_ids.append(feature.input_ids)
-        tensor_attention_masks.append(feature.attention_mask)
-        tensor_label_ids.append(feature.label)
-
-        if feature.token_type_ids:
-            tensor_token_type_ids.append(feature.token_type_ids)
-
-    tensor_input_ids = torch.tensor(tensor_input_ids, dtype=torch.long)
-    tensor_attention_masks = torch.tensor(tensor_attention_masks, dtype=torch.long)
-    tensor_token_type_ids = torch.tensor(tensor_token_type_ids, dtype=torch.long) if tensor_token_type_ids \
-        else torch.zeros(tensor_attention_masks.shape)
+    if logger and logger.isEnabledFor(logging.DEBUG):
+        for idx in range(min(3, len(features))):
+            logger.debug("Feature{}:\ninput_ids={}\nattention_mask={}\nlabel={}\n".format(
+                idx + 1, features.input_ids[idx].tolist(), features.attention_mask[idx].tolist(), features.label[idx]))
+
+    # keep everything as int64 numpy arrays on host so torch.from_numpy shares memory instead of copying
+    input_ids = np.ascontiguousarray(features.input_ids, dtype=np.int64)
+    attention_masks = np.ascontiguousarray(features.attention_mask, dtype=np.int64)
+    token_type_ids = np.ascontiguousarray(features.token_type_ids, dtype=np.int64) \
+        if features.token_type_ids is not None else np.zeros(attention_masks.shape, dtype=np.int64)
     if binary_mode:
-        dmap = {0: [1, 0], 1: [0, 1]}
-        tensor_label_ids = torch.tensor([dmap[e] for e in tensor_label_ids], dtype=torch.float32)
+        # one-hot labels: 0 -> [1, 0]; 1 -> [0, 1]
+        label_ids = np.eye(2, dtype=np.float32)[features.label]
     else:
-        tensor_label_ids = torch.tensor(tensor_label_ids, dtype=torch.long)
+        label_ids = np.ascontiguousarray(features.label, dtype=np.int64)
+
+    tensor_input_ids = torch.from_numpy(input_ids)
+    tensor_attention_masks = torch.from_numpy(attention_masks)
+    tensor_token_type_ids = torch.from_numpy(token_type_ids)
+    tensor_label_ids = torch.from_numpy(label_ids)
 
     return TensorDataset(tensor_input_ids, tensor_attention_masks, tensor_token_type_ids, tensor_label_ids)
 
 
-def relation_extraction_data_loader(dataset, batch_size=2, task='train', logger=None, binary_mode=False):
+def trim_batch_padding(batch):
+    """
+        collate function for dynamic padding
+        stack the examples and drop the columns that are padding for every example in the batch
+        (columns are selected by attention mask so it works for both right and left padding)
+    """
+    input_ids, attention_mask, token_type_ids, labels = default_collate(batch)
+    keep = attention_mask.any(dim=0)
+
+    return [input_ids[:, keep], attention_mask[:, keep], token_type_ids[:, keep], labels]
+
+
+class BucketBatchSampler(Sampler):
+    """
+        yield batches of examples with similar lengths
+        examples are shuffled, split into mega batches of mega_batch_factor * batch_size,
+        sorted by length inside each mega batch and cut into batches; the batch order is shuffled again
+    """
+
+    def __init__(self, lengths, batch_size, mega_batch_factor=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.mega_batch_size = batch_size * mega_batch_factor
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).numpy()
+        batches = []
+        for start in range(0, len(indices), self.mega_batch_size):
+            mega_batch = indices[start:start + self.mega_batch_size]
+            mega_batch = mega_batch[np.argsort(self.lengths[mega_batch], kind="stable")]
+            batches.extend(mega_batch[i:i + self.batch_size].tolist()
+                           for i in range(0, len(mega_batch), self.batch_size))
+
+        for idx in torch.randperm(len(batches)).tolist():
+            yield batches[idx]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def relation_extraction_data_loader(dataset, batch_size=2, task='train', logger=None, binary_mode=False,
+                                    num_workers=0, dynamic_padding=False):
     """
     task has two levels:
     train for training using RandomSampler
     test for evaluation and prediction using SequentialSampler
 
+    num_workers > 0 builds batches in background worker processes (kept alive across epochs)
+
+    dynamic_padding trims each batch to its longest example instead of max_seq_length;
+    for train, batches are also bucketed by length (BucketBatchSampler)
+
     if set auto to True we will default call convert_features_to_tensors,
     so features can be directly passed into the function
     """
     dataset = features2tensors(dataset, binary_mode=binary_mode, logger=logger)
 
-    if task == 'train':
-        sampler = RandomSampler(dataset)
+    if task == 'train' and dynamic_padding:
+        lengths = dataset.tensors[1].sum(dim=1).numpy()
+        sampler_kwargs = {"batch_sampler": BucketBatchSampler(lengths, batch_size)}
+    elif task == 'train':
+        sampler_kwargs = {"sampler": RandomSampler(dataset), "batch_size": batch_size}
     elif task == 'test':
-        sampler = SequentialSampler(dataset)
+        sampler_kwargs = {"sampler": SequentialSampler(dataset), "batch_size": batch_size}
     else:
         raise ValueError('task argument only support train or test but get {}'.format(task))
 
-    data_loader = DataLoader(dataset, sampler=sampler, batch_size=batch_size, pin_memory=True)
+    collate_fn = trim_batch_padding if dynamic_padding else None
+    # persistent_workers and prefetch_factor are only valid with worker processes
+    worker_kwargs = {"persistent_workers": True, "prefetch_factor": 4} if num_workers > 0 else {}
+    data_loader = DataLoader(dataset, collate_fn=collate_fn, pin_memory=True,
+                             num_workers=num_workers, **sampler_kwargs, **worker_kwargs)
 
     return data_loader
 
 
 def batch_to_model_input(batch, model_type="bert", device=torch.device("cpu")):
-    return {"input_ids": batch[0].to(device),
-            "attention_mask": batch[1].to(device),
-            "labels": batch[3].to(device),
-            "token_type_ids": batch[2].to(device) if model_type in MODEL_REQUIRE_SEGMENT_ID else None}
+    # batches come from pinned memory (pin_memory=True) so host to device copies can be asynchronous
+    return {"input_ids": batch[0].to(device, non_blocking=True),
+            "attention_mask": batch[1].to(device, non_blocking=True),
+            "labels": batch[3].to(device, non_blocking=True),
+            "token_type_ids": batch[2].to(device, non_blocking=True)
+            if model_type in MODEL_REQUIRE_SEGMENT_ID else None}
+
+
+class CUDAPrefetcher(object):
+    """
+        wrap a data loader and yield model inputs (see batch_to_model_input)
+        on GPU, the next batch is copied to device on a side stream while the current batch is computed;
+        the copies go into preallocated device buffers (two slots used in turn) instead of new tensors
+        on CPU, batches are converted one by one without prefetching
+
+        buffer_pool can be shared between prefetchers (e.g. train and eval) to allocate the buffers only once
+    """
+
+    def __init__(self, data_loader, model_type="bert", device=torch.device("cpu"), buffer_pool=None):
+        self.data_loader = data_loader
+        self.model_type = model_type
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+        self.buffer_pool = buffer_pool if buffer_pool is not None else [dict(), dict()]
+        self._slot = 0
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.data_loader)
+        next_input = self._preload(loader_iter)
+
+        while next_input is not None:
+            if self.stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch_input = next_input
+            next_input = self._preload(loader_iter)
+            yield batch_input
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+
+        if self.stream is None:
+            return batch_to_model_input(batch, model_type=self.model_type, device=self.device)
+
+        slot = self.buffer_pool[self._slot]
+        self._slot = (self._slot + 1) % len(self.buffer_pool)
+        main_stream = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self.stream):
+            # the slot was last used by an earlier batch; wait until the work queued for it is done
+            self.stream.wait_stream(main_stream)
+            return {"input_ids": self._copy_to_buffer(slot, "input_ids", batch[0]),
+                    "attention_mask": self._copy_to_buffer(slot, "attention_mask", batch[1]),
+                    "labels": self._copy_to_buffer(slot, "labels", batch[3]),
+                    "token_type_ids": self._copy_to_buffer(slot, "token_type_ids", batch[2])
+                    if self.model_type in MODEL_REQUIRE_SEGMENT_ID else None}
+
+    def _copy_to_buffer(self, slot, name, tensor):
+        # buffers are flat so a smaller batch (last batch, dynamic padding) uses a contiguous prefix
+        buffer = slot.get(name, None)
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.numel() < tensor.numel():
+            buffer = torch.empty(tensor.numel(), dtype=tensor.dtype, device=self.device)
+            slot[name] = buffer
+        device_tensor = buffer[:tensor.numel()].view(tensor.shape)
+        device_tensor.copy_(tensor, non_blocking=True)
+
+        return device_tensor
 
 
 class DataProcessor(object):
@@ -158,14 +328,20 @@ class DataProcessor(object):
             self.data_dir = data_dir
 
         self.tokenizer = None
+        self.spec_tag_ids = None
         self.max_seq_len = max_seq_len
         self.num_core = num_core
         self.header = header
         self.tokenizer_type = tokenizer_type
         self.total_special_token_num = 3
+        # label frequency of each scanned train file; shared by get_labels and get_sample_distribution
+        self._label_counts_cache = dict()
+        # rows of each scanned train file, kept until get_train_examples uses them so train.tsv is read only once
+        self._train_lines_cache = dict()
 
     def __str__(self):
-        rep = [f"key: {k}; val: {v}" for k, v in self.__dict__.items()]
+        # skip the private caches (label counts and the rows of the train file)
+        rep = [f"key: {k}; val: {v}" for k, v in self.__dict__.items() if not k.startswith("_")]
         return "\n".join(rep)
 
     def set_data_dir(self, data_dir):
@@ -173,6 +349,7 @@ class DataProcessor(object):
 
     def set_tokenizer(self, tokenizer):
         self.tokenizer = tokenizer
+        self.spec_tag_ids = frozenset(tokenizer.convert_tokens_to_ids(SPEC_TAGS))
 
     def set_max_seq_len(self, max_seq_len):
         self.max_seq_len = max_seq_len
@@ -189,9 +366,11 @@ class DataProcessor(object):
     def get_train_examples(self, filename=None):
         """See base class."""
         input_file_name = self.data_dir / filename if filename else self.data_dir / "train.tsv"
+        # reuse the rows read when the labels were counted instead of reading the file again
+        lines = self._train_lines_cache.pop(input_file_name.resolve(), None)
 
         return self._create_examples(
-            self._read_tsv(input_file_name), "train")
+            self._read_tsv(input_file_name) if lines is None else lines, "train")
 
     def get_dev_examples(self, filename=None):
         """See base class."""
@@ -209,16 +388,9 @@ class DataProcessor(object):
 
     def get_sample_distribution(self, train_file=None):
         # the distribution will be measured based on training data
-        if train_file:
-            lines = self._read_tsv(train_file)
-        else:
-            lines = self._read_tsv(self.data_dir / "train.tsv")
-
-        labels = []
-        for (i, line) in enumerate(lines):
-            labels.append(line[0])
-        total = len(labels)
-        label2freq = {k: (1-v/total) for k, v in Counter(labels).items()}
+        label_counts = self._get_label_counts(train_file if train_file else self.data_dir / "train.tsv")
+        total = sum(label_counts.values())
+        label2freq = {k: (1-v/total) for k, v in label_counts.items()}
 
         return label2freq
 
@@ -234,15 +406,9 @@ class DataProcessor(object):
             with open(label_file, "r") as f:
                 unique_labels = [e.strip() for e in f.read().strip().split("\n")]
         elif label_file is None and train_file:
-            lines = self._read_tsv(train_file)
-            unique_labels = set()
-            for (i, line) in enumerate(lines):
-                unique_labels.add(line[0])
+            unique_labels = set(self._get_label_counts(train_file))
         elif label_file is None and train_file is None and self.data_dir:
-            lines = self._read_tsv(self.data_dir / "train.tsv")
-            unique_labels = set()
-            for (i, line) in enumerate(lines):
-                unique_labels.add(line[0])
+            unique_labels = set(self._get_label_counts(self.data_dir / "train.tsv"))
         else:
             raise RuntimeError("Cannot find files to generate labels"
                                "You need one of label_file, train_file (full path) or data_dir setup")
@@ -252,6 +418,79 @@ class DataProcessor(object):
 
         return unique_labels, label2idx, idx2label
 
+    def _encode(self, texts_a, texts_b=None):
+        """tokenize a batch with the same truncation and padding as convert_examples_to_relation_extraction_features"""
+        return self.tokenizer(texts_a, texts_b, padding='max_length', truncation='longest_first',
+                              max_length=self.max_seq_len, return_tensors='np')
+
+    def _encode_keeping_spec_tags(self, texts_a, texts_b=None, total_special_toks=3):
+        """
+            encode all rows with one batched tokenizer call and check if its longest_first truncation to max_seq_len
+            keeps all the special tags of each row; only the rows that lost a tag are truncated by the tag-aware
+            _process_seq_len loop (texts are updated in place) and encoded again, also in one batched call
+            return one encoding per row
+        """
+        if not texts_a:
+            return []
+
+        encodings = self._encode(texts_a, texts_b)
+        num_kept_tags = np.isin(encodings['input_ids'], list(self.spec_tag_ids)).sum(axis=1)
+        lost_rows = []
+        for (idx, num_kept) in enumerate(num_kept_tags.tolist()):
+            text = texts_a[idx] + " " + texts_b[idx] if texts_b else texts_a[idx]
+            if sum(w.lower() in SPEC_TAG_SET for w in text.split(" ")) != num_kept:
+                lost_rows.append(idx)
+
+        for idx in tqdm(lost_rows, disable=not lost_rows):
+            if texts_b:
+                texts_a[idx], texts_b[idx] = self._process_seq_len(texts_a[idx], texts_b[idx], total_special_toks)
+            else:
+                texts_a[idx] = self._process_seq_len(texts_a[idx])
+
+        if lost_rows:
+            truncated = self._encode([texts_a[idx] for idx in lost_rows],
+                                     [texts_b[idx] for idx in lost_rows] if texts_b else None)
+            for key in encodings:
+                encodings[key][lost_rows] = truncated[key]
+
+        return [{key: encodings[key][idx] for key in encodings} for idx in range(len(texts_a))]
+
+    def _word_piece_counts(self, words):
+        """
+            count the word pieces of each word as it is tokenized in the joined text
+            every word but the first is preceded by a space, which changes the pieces of byte-level BPE
+            tokenizers (RoBERTa, LongFormer, DeBERTa): 'nsaids' -> n said s but ' nsaids' -> Ġnsaids
+        """
+        return [len(self.tokenizer.tokenize(w if idx == 0 else " " + w)) for (idx, w) in enumerate(words)]
+
+    def _pop_word(self, words, piece_counts, idx):
+        """remove words[idx] in place; return the number of word pieces removed"""
+        words.pop(idx)
+        removed = piece_counts.pop(idx)
+        if idx == 0 and words:
+            # the new leading word is no longer preceded by a space
+            head_count = len(self.tokenizer.tokenize(words[0]))
+            removed += piece_counts[0] - head_count
+            piece_counts[0] = head_count
+        return removed
+
+    def release_train_lines(self):
+        """drop the train rows kept for get_train_examples (e.g. when the train features are loaded from cache)"""
+        self._train_lines_cache.clear()
+
+    def _get_label_counts(self, train_file):
+        """
+            count labels (first column) of the train file in a single pass; cached per file
+            the rows are kept for get_train_examples so the file is not read again
+        """
+        train_file = Path(train_file).resolve()
+        if train_file not in self._label_counts_cache:
+            lines = list(self._read_tsv(train_file))
+            self._label_counts_cache[train_file] = Counter(line[0] for line in lines)
+            self._train_lines_cache[train_file] = lines
+
+        return self._label_counts_cache[train_file]
+
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
         raise NotImplementedError(
@@ -259,17 +498,13 @@ class DataProcessor(object):
 
     @staticmethod
     def _read_tsv(input_file, header=True, quotechar=None):
-        """Reads a tab separated value file."""
-        lines = []
-
+        """Reads a tab separated value file; yield one line at a time."""
         with open(input_file, "r", encoding="utf-8") as f:
             reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
+            if header:
+                next(reader, None)
             for line in reader:
-                lines.append(line)
-        if header:
-            lines = lines[1:]
-
-        return lines
+                yield line
 
 
 class RelationDataFormatSepProcessor(DataProcessor):
@@ -282,19 +517,21 @@ class RelationDataFormatSepProcessor(DataProcessor):
 
     def _create_examples_helper(self, lines_idx, set_type, total_special_toks):
         start_idx, lines = lines_idx
+        labels, texts_a, texts_b = [], [], []
+        for line in lines:
+            labels.append(line[0])
+            texts_a.append(line[1])
+            texts_b.append(line[2])
+        # text after tokenization has a len > max_seq_len:
+        # 1. skip all these cases
+        # 2. use truncate strategy
+        # we adopt truncate way (2) in this implementation as _process_seq_len
+        encodings = self._encode_keeping_spec_tags(texts_a, texts_b, total_special_toks=total_special_toks)
         examples = []
-        for (i, line) in enumerate(tqdm(lines)):
+        for (i, label) in enumerate(labels):
             guid = "{}_{}_{}".format(set_type, start_idx, i)
-            text_a = line[1]
-            text_b = line[2]
-            label = line[0]
-            # text after tokenization has a len > max_seq_len:
-            # 1. skip all these cases
-            # 2. use truncate strategy
-            # we adopt truncate way (2) in this implementation as _process_seq_len
-            text_a, text_b = self._process_seq_len(text_a, text_b, total_special_toks=total_special_toks)
-            examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
+            examples.append(InputExample(
+                guid=guid, text_a=texts_a[i], text_b=texts_b[i], label=label, encoding=encodings[i]))
         return examples
 
     def _create_examples(self, lines, set_type):
@@ -311,7 +548,7 @@ class RelationDataFormatSepProcessor(DataProcessor):
             # use multi-cores to process data if you have many long sentences;
             # otherwise single process should be faster
             examples = []
-            array_lines = np.array_split(lines, self.num_core)
+            array_lines = np.array_split(list(lines), self.num_core)
             with ProcessPoolExecutor(max_workers=self.num_core) as exe:
                 for each in exe.map(partial(self._create_examples_helper,
                                             set_type=set_type,
@@ -321,23 +558,26 @@ class RelationDataFormatSepProcessor(DataProcessor):
 
         return examples
 
-    @staticmethod
-    def _truncate_helper(text):
-        tokens = text.split(" ")
-        spec_tag_idx1, spec_tag_idx2 = [idx for (idx, tk) in enumerate(tokens) if tk.lower() in SPEC_TAGS]
-        start_idx, end_idx = 0, len(tokens) - 1
+    def _truncate_helper(self, words, piece_counts, spec_tag_idx):
+        """
+            remove one word from head or tail (whichever is farther from the special tags) in place
+            return the number of word pieces removed; None if both tags are already at the edges
+        """
+        spec_tag_idx1, spec_tag_idx2 = spec_tag_idx
+        start_idx, end_idx = 0, len(words) - 1
         truncate_space_head = spec_tag_idx1 - start_idx
         truncate_space_tail = end_idx - spec_tag_idx2
 
         if truncate_space_head == truncate_space_tail == 0:
-            return text
+            return None
 
         if truncate_space_head > truncate_space_tail:
-            tokens.pop(0)
+            # all tags shift left by one after removing the leading word
+            spec_tag_idx[0] -= 1
+            spec_tag_idx[1] -= 1
+            return self._pop_word(words, piece_counts, 0)
         else:
-            tokens.pop(-1)
-
-        return " ".join(tokens)
+            return self._pop_word(words, piece_counts, end_idx)
 
     def _process_seq_len(self, text_a, text_b, total_special_toks=3):
         """
@@ -348,19 +588,41 @@ class RelationDataFormatSepProcessor(DataProcessor):
             first -1- tag1 entity tag2 -2- last
             4. pick the longest distance from (1, 2), if 1 remove first token, if 2 remove last token
             5. repeat until len is equal to max_seq_len
+            Each word is tokenized only once; the loop updates cached word piece counts instead of re-tokenizing.
+            Only used for the rows whose special tags the tokenizer truncation does not keep
+            (see DataProcessor._encode_keeping_spec_tags).
         """
-        flag = True
+        words_a, words_b = text_a.split(" "), text_b.split(" ")
+        piece_counts_a = self._word_piece_counts(words_a)
+        piece_counts_b = self._word_piece_counts(words_b)
+        total = sum(piece_counts_a) + sum(piece_counts_b)
+        max_len = self.max_seq_len - total_special_toks
 
-        while len(self.tokenizer.tokenize(text_a) + self.tokenizer.tokenize(text_b)) \
-                > (self.max_seq_len - total_special_toks):
+        if total <= max_len:
+            return text_a, text_b
+
+        spec_tag_idx_a = [idx for (idx, w) in enumerate(words_a) if w.lower() in SPEC_TAG_SET]
+        spec_tag_idx_b = [idx for (idx, w) in enumerate(words_b) if w.lower() in SPEC_TAG_SET]
+        flag = True
+        # number of consecutive turns without a removable word; stop once neither text can be truncated
+        stuck = 0
 
+        while total > max_len and stuck < 2:
             if flag:
-                text_a = self._truncate_helper(text_a)
+                removed = self._truncate_helper(words_a, piece_counts_a, spec_tag_idx_a)
             else:
-                text_b = self._truncate_helper(text_b)
+                removed = self._truncate_helper(words_b, piece_counts_b, spec_tag_idx_b)
+
+            if removed is None:
+                stuck += 1
+            else:
+                stuck = 0
+                total -= removed
 
             flag = not flag
 
+        text_a, text_b = " ".join(words_a), " ".join(words_b)
+
         return text_a, text_b
 
 
@@ -373,19 +635,18 @@ class RelationDataFormatUniProcessor(DataProcessor):
     def _create_examples_helper(self, lines_idx, set_type, total_special_toks):
         examples = []
         start_idx, lines = lines_idx
-        for (i, line) in enumerate(lines):
+        labels, texts_a = [], []
+        for line in lines:
+            labels.append(line[0])
+            texts_a.append(" ".join([line[1], line[2]]))
+        # text after tokenization has a len > max_seq_len:
+        # 1. skip all these cases
+        # 2. use truncate strategy (truncate from both side) (adopted)
+        encodings = self._encode_keeping_spec_tags(texts_a)
+        for (i, label) in enumerate(labels):
             guid = "%s-%s-%s" % (set_type, start_idx, i)
-            text_a = line[1]
-            text_a_1 = line[2]
-            text_a = " ".join([text_a, text_a_1])
-            label = line[0]
-            # text after tokenization has a len > max_seq_len:
-            # 1. skip all these cases
-            # 2. use truncate strategy (truncate from both side) (adopted)
-            text_a = self._process_seq_len(text_a)
-
             examples.append(
-                InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
+                InputExample(guid=guid, text_a=texts_a[i], text_b=None, label=label, encoding=encodings[i]))
 
         return examples
 
@@ -401,7 +662,7 @@ class RelationDataFormatUniProcessor(DataProcessor):
         else:
             # multi-process
             examples = []
-            array_lines = np.array_split(lines, self.num_core)
+            array_lines = np.array_split(list(lines), self.num_core)
             with ProcessPoolExecutor(max_workers=self.num_core) as exe:
                 for each in exe.map(partial(self._create_examples_helper,
                                             set_type=set_type,
@@ -415,9 +676,18 @@ class RelationDataFormatUniProcessor(DataProcessor):
         """
             see RelationDataFormatSepProcessor._process_seq_len for details
         """
-        while len(self.tokenizer.tokenize(text_a)) > (self.max_seq_len - 2):
-            w1 = text_a.split(" ")
-            t1, t2, t3, t4 = [idx for (idx, w) in enumerate(w1) if w.lower() in SPEC_TAGS]
+        w1 = text_a.split(" ")
+        piece_counts = self._word_piece_counts(w1)
+        total = sum(piece_counts)
+        max_len = self.max_seq_len - 2
+
+        if total <= max_len:
+            return text_a
+
+        spec_tag_idx = [idx for (idx, w) in enumerate(w1) if w.lower() in SPEC_TAG_SET]
+
+        while total > max_len:
+            t1, t2, t3, t4 = spec_tag_idx
             ss1, mid1, se1 = 0, (len(w1) - 1) // 2, len(w1) - 1
 
             a1 = t1 - ss1
@@ -426,14 +696,18 @@ class RelationDataFormatUniProcessor(DataProcessor):
             d1 = t3 - mid1
             m_idx = max(a1, b1, c1, d1)
             if a1 == m_idx:
-                w1.pop(0)
+                pop_idx = 0
             elif b1 == m_idx:
-                w1.pop(-1)
+                pop_idx = len(w1) - 1
             elif c1 == m_idx:
-                w1.pop((t2 + c1 // 2))
+                pop_idx = t2 + c1 // 2
             else:
-                w1.pop((t3 - d1 // 2))
+                pop_idx = t3 - d1 // 2
+
+            total -= self._pop_word(w1, piece_counts, pop_idx)
+            # shift the tags after the removed word; a removed tag is dropped as in the rescan
+            spec_tag_idx = [idx - (idx > pop_idx) for idx in spec_tag_idx if idx != pop_idx]
 
-            text_a = " ".join(w1)
+        text_a = " ".join(w1)
 
         return text_a
@@ -16,6 +16,12 @@ from model_utils import StableDropout, FocalLoss, BCEFocalLoss
 logger = TransformerLogger(logger_level='i').get_logger()
 
 
+def run_eagerly(fn):
+    # keep fn out of torch.compile graphs (torch>=2.1); no-op for older torch
+    compiler = getattr(torch, "compiler", None)
+    return compiler.disable(fn) if hasattr(compiler, "disable") else fn
+
+
 class BaseModel(PreTrainedModel):
 
     def __init__(self, config):
@@ -57,6 +63,7 @@ class BaseModel(PreTrainedModel):
         self.base_classifier = nn.Linear(self.classifier_dim, self.num_labels)
 
     @staticmethod
+    @run_eagerly
     def special_tag_representation(seq_output, input_ids, special_tag):
         spec_idx = (input_ids == special_tag).nonzero(as_tuple=False)
 
@@ -149,6 +149,8 @@ if __name__ == '__main__':
                         help="logging after how many steps of training. If < 0, no log during training")
     parser.add_argument("--num_core", default=1, type=int,
                         help="how many cores used for multiple process for data generation")
+    parser.add_argument("--num_workers", default=2, type=int,
+                        help="how many worker processes the data loaders use to prepare batches; 0 for main process")
     parser.add_argument("--non_relation_label", default="NonRel", type=str,
                         help="The label used for representing "
                              "candidate entity pairs that is not a true relation (negative sample)")
@@ -157,8 +159,13 @@ if __name__ == '__main__':
     parser.add_argument('--fp16', action='store_true',
                         help="Whether to use 16-bit float precision instead of 32-bit")
     parser.add_argument("--fp16_opt_level", type=str, default="O1",
-                        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-                             "See details at https://nvidia.github.io/apex/amp.html")
+                        help="Not used: fp16 training uses PyTorch native amp (torch.cuda.amp) instead of Apex AMP; "
+                             "kept for compatibility with existing configs")
+    parser.add_argument('--use_dynamic_padding', action='store_true',
+                        help="Whether to pad each batch to its longest example instead of max_seq_length "
+                             "(training batches are also grouped by length)")
+    parser.add_argument('--use_torch_compile', action='store_true',
+                        help="Whether to compile the model with torch.compile (require torch>=2.0)")
     parser.add_argument('--use_focal_loss', action='store_true',
                         help="Whether to use focal loss function to replace cross entropy loss function")
     parser.add_argument("--focal_loss_gamma", default=2, type=int,
@@ -42,10 +42,13 @@ class Args:
         self.log_lvl = "i"
         self.log_step = 100
         self.num_core = 4
+        self.num_workers = 2
         self.non_relation_label = "nonRel"
         self.progress_bar = True
         self.fp16 = False
         self.fp16_opt_level = "O1"
+        self.use_dynamic_padding = False
+        self.use_torch_compile = False
         self.use_focal_loss = False
         self.focal_loss_gamma = 2
         self.use_binary_classification_mode = False
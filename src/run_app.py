@@ -8,7 +8,7 @@ We used deberta as an example
 """
 from models import BaseModel
 from data_utils import RelationDataFormatSepProcessor
-from transformers import DebertaForSequenceClassification, DebertaModel, DebertaConfig, DebertaTokenizer
+from transformers import DebertaForSequenceClassification, DebertaModel, DebertaConfig, DebertaTokenizerFast
 from task import TaskRunner
 from utils import TransformerLogger
 
@@ -102,10 +102,13 @@ class Args:
         self.log_lvl = "i"
         self.log_step = 2
         self.num_core = 4
+        self.num_workers = 2
         self.non_relation_label = "nonRel"
         self.progress_bar = False
         self.fp16 = False
         self.fp16_opt_level = "O1"
+        self.use_dynamic_padding = False
+        self.use_torch_compile = False
         self.use_focal_loss = False
         self.focal_loss_gamma = 2
         self.use_binary_classification_mode = False
@@ -129,7 +132,7 @@ def app():
     task_runner = TaskRunner(args)
 
     # add deberta to model dict
-    task_runner.model_dict['deberta'] = (DeBERTaRelationExtraction, DebertaConfig, DebertaTokenizer)
+    task_runner.model_dict['deberta'] = (DeBERTaRelationExtraction, DebertaConfig, DebertaTokenizerFast)
     # set deberta data processor for data processing
     task_runner.data_processor = DeBERTaDataProcessor(
         max_seq_len=args.max_seq_length, num_core=args.num_core)
@@ -3,21 +3,19 @@ This script is used for training and test
 """
 
 
-# from data_utils import convert_examples_to_relation_extraction_features
-from data_utils import (features2tensors, relation_extraction_data_loader,
-                        batch_to_model_input, RelationDataFormatSepProcessor,
-                        RelationDataFormatUniProcessor)
+from data_utils import (features2tensors, relation_extraction_data_loader, RelationDataFormatSepProcessor,
+                        RelationDataFormatUniProcessor, convert_examples_to_relation_extraction_features,
+                        CUDAPrefetcher, save_features, load_features, has_cached_features)
 from utils import acc_and_f1
 from data_processing.io_utils import pkl_save, pkl_load, save_json
-from transformers import glue_convert_examples_to_features as convert_examples_to_relation_extraction_features
 from transformers import get_linear_schedule_with_warmup, get_cosine_schedule_with_warmup
 import torch
 from tqdm import trange, tqdm
 import numpy as np
-from packaging import version
 from pathlib import Path
 from config import SPEC_TAGS, MODEL_DICT, VERSION, NEW_ARGS, CONFIG_VERSION_NAME
 import shutil
+import hashlib
 
 
 class TaskRunner(object):
@@ -34,6 +32,9 @@ class TaskRunner(object):
         self.new_model_dir_path = Path(self.args.new_model_dir)
         self.new_model_dir_path.mkdir(parents=True, exist_ok=True)
         self._use_amp_for_fp16_from = 0
+        self._init_cuda_backends()
+        # device buffers for batch inputs, shared by all CUDAPrefetchers of this runner
+        self.gpu_buffer_pool = [dict(), dict()]
 
     def task_runner_default_init(self):
         # set up data processor
@@ -56,7 +57,7 @@ class TaskRunner(object):
         # init or reload model
         if self.args.do_train:
             # init amp for fp16 (mix precision training)
-            # _use_amp_for_fp16_from: 0 for no fp16; 1 for naive PyTorch amp; 2 for apex amp
+            # _use_amp_for_fp16_from: 0 for no fp16; 1 for naive PyTorch amp
             if self.args.fp16:
                 self._load_amp_for_fp16()
             self._init_new_model()
@@ -84,14 +85,12 @@ class TaskRunner(object):
 
         epoch_iter = trange(self.args.num_train_epochs, desc="Epoch", disable=not self.args.progress_bar)
         for epoch in epoch_iter:
-            batch_iter = tqdm(self.train_data_loader, desc="Batch", disable=not self.args.progress_bar)
+            batch_iter = tqdm(CUDAPrefetcher(self.train_data_loader, model_type=self.args.model_type,
+                                             device=self.args.device, buffer_pool=self.gpu_buffer_pool),
+                              desc="Batch", disable=not self.args.progress_bar)
             batch_total_step = len(self.train_data_loader)
-            for step, batch in enumerate(batch_iter):
-                self.model.train()
-                self.model.zero_grad()
-
-                batch_input = batch_to_model_input(batch, model_type=self.args.model_type, device=self.args.device)
-
+            self.model.train()
+            for step, batch_input in enumerate(batch_iter):
                 if self.args.fp16 and self._use_amp_for_fp16_from == 1:
                     with self.amp.autocast():
                         batch_output = self.model(**batch_input)
@@ -104,31 +103,24 @@ class TaskRunner(object):
                 tr_loss += loss.item()
 
                 if self.args.fp16:
-                    if self._use_amp_for_fp16_from == 1:
-                        self.amp_scaler.scale(loss).backward()
-                    elif self._use_amp_for_fp16_from == 2:
-                        with self.amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                            scaled_loss.backward()
+                    self.amp_scaler.scale(loss).backward()
                 else:
                     loss.backward()
 
                 # update gradient
                 if (step + 1) % self.args.gradient_accumulation_steps == 0 or (step + 1) == batch_total_step:
                     if self.args.fp16:
-                        if self._use_amp_for_fp16_from == 1:
-                            self.amp_scaler.unscale_(self.optimizer)
-                            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
-                            self.amp_scaler.step(self.optimizer)
-                            self.amp_scaler.update()
-                        elif self._use_amp_for_fp16_from == 2:
-                            torch.nn.utils.clip_grad_norm_(self.amp.master_params(self.optimizer),
-                                                           self.args.max_grad_norm)
-                            self.optimizer.step()
+                        self.amp_scaler.unscale_(self.optimizer)
+                        torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
+                        self.amp_scaler.step(self.optimizer)
+                        self.amp_scaler.update()
                     else:
                         torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
                         self.optimizer.step()
                     if self.args.do_warmup:
                         self.scheduler.step()
+                    # clear gradients only after an update so they accumulate over gradient_accumulation_steps
+                    self.optimizer.zero_grad(set_to_none=True)
                     # batch_iter.set_postfix({"loss": loss.item(), "tloss": tr_loss/step})
                 if self.args.log_step > 0 and (step+1) % self.args.log_step == 0:
                     self.args.logger.info(
@@ -166,7 +158,7 @@ class TaskRunner(object):
         self.args.logger.info("start evaluation...")
 
         # this is done on dev
-        true_labels = np.array([dev_fea.label for dev_fea in self.dev_features])
+        true_labels = self.dev_features.label
         preds, eval_loss = self._run_eval(self.dev_data_loader)
         eval_res = acc_and_f1(
             labels=true_labels, preds=preds, label2idx=self.label2idx, non_rel_label=non_rel_label)
@@ -236,6 +228,7 @@ class TaskRunner(object):
 
         # load model to device
         self.model.to(self.args.device)
+        self._compile_model()
 
     def _init_optimizer(self):
         # set up optimizer
@@ -261,11 +254,6 @@ class TaskRunner(object):
                                                              num_warmup_steps=warmup_steps,
                                                              num_training_steps=t_total)
 
-        # mix precision training
-        if self.args.fp16 and self._use_amp_for_fp16_from == 2:
-            self.model, self.optimizer = self.amp.initialize(self.model, self.optimizer,
-                                                             opt_level=self.args.fp16_opt_level)
-
     def _init_trained_model(self):
         """initialize a fine-tuned model for prediction"""
         dir_list = [d for d in self.new_model_dir_path.iterdir() if d.is_dir()]
@@ -287,22 +275,39 @@ class TaskRunner(object):
         self.label2idx, self.idx2label = pkl_load(latest_ckpt_dir/"label_index.pkl")
         # load model to device
         self.model.to(self.args.device)
+        self._compile_model()
+
+    def _init_cuda_backends(self):
+        # cudnn autotuning picks the fastest kernel once per input shape and caches it
+        # TF32 tensor cores speed up float32 matmul on Ampere or newer GPUs
+        if self.args.device.type != "cuda":
+            return
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        if hasattr(torch, "set_float32_matmul_precision"):
+            torch.set_float32_matmul_precision("high")
+
+    def _compile_model(self):
+        # fuse kernels with torch.compile (torch>=2.0). shapes are not fixed: the last batch is usually smaller
+        # and dynamic padding varies the sequence length; dynamo recompiles once and marks those dims dynamic, and
+        # train and eval (grad mode) are compiled once each. special_tag_representation runs eagerly
+        # (data-dependent indexing), so the classification head falls back to eager; the encoder stays compiled.
+        # reduce-overhead replays CUDA graphs, which cannot be dynamic: one graph (with its own memory pool) is
+        # recorded per input shape. that is a few graphs for fixed padding but up to one per
+        # (batch size, sequence length) with dynamic padding, so the default mode is used there
+        if not self.args.use_torch_compile:
+            return
+        if not hasattr(torch, "compile"):
+            self.args.logger.warning("torch.compile requires torch>=2.0; the model will run in eager mode.")
+            return
+        mode = "default" if self.args.use_dynamic_padding else "reduce-overhead"
+        self.model = torch.compile(self.model, mode=mode)
 
     def _load_amp_for_fp16(self):
-        # first try to load PyTorch naive amp; if fail, try apex; if fail again, throw a RuntimeError
-        if version.parse(torch.__version__) >= version.parse("1.6.0"):
-            self.amp = torch.cuda.amp
-            self._use_amp_for_fp16_from = 1
-            self.amp_scaler = torch.cuda.amp.GradScaler()
-        else:
-            try:
-                from apex import amp
-                self.amp = amp
-                self._use_amp_for_fp16_from = 2
-            except ImportError:
-                self.args.logger.error("apex (https://www.github.com/nvidia/apex) for fp16 training is not installed.")
-            finally:
-                self.args.fp16 = False
+        # PyTorch naive amp (torch>=1.6; requirements.txt asks for torch>=1.7)
+        self.amp = torch.cuda.amp
+        self._use_amp_for_fp16_from = 1
+        self.amp_scaler = torch.cuda.amp.GradScaler()
 
     def _save_model(self, epoch=0):
         dir_to_save = self.new_model_dir_path / f"ckpt_{epoch}"
@@ -319,27 +324,32 @@ class TaskRunner(object):
             shutil.rmtree(oldest_ckpt_dir)
 
     def _run_eval(self, data_loader):
-        temp_loss = .0
+        # loss and predictions stay on device during the loop so there is no host sync per batch
+        temp_loss = torch.zeros((), device=self.args.device)
         # set model to evaluate mode
         self.model.eval()
 
         # create dev data batch iteration
-        batch_iter = tqdm(data_loader, desc="Batch", disable=not self.args.progress_bar)
+        batch_iter = tqdm(CUDAPrefetcher(data_loader, model_type=self.args.model_type, device=self.args.device,
+                                         buffer_pool=self.gpu_buffer_pool),
+                          desc="Batch", disable=not self.args.progress_bar)
         total_sample_num = len(batch_iter)
-        preds = None
+        preds = []
+
+        # inference_mode (torch>=1.9) also skips autograd version counter and view tracking
+        eval_mode = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
 
-        for batch in batch_iter:
-            batch_input = batch_to_model_input(batch, model_type=self.args.model_type, device=self.args.device)
-            with torch.no_grad():
+        for batch_input in batch_iter:
+            with eval_mode():
                 batch_output = self.model(**batch_input)
                 loss, logits = batch_output[:2]
-                temp_loss += loss.item()
-                logits = logits.detach().cpu().numpy()
-                preds = logits if preds is None else np.append(preds, logits, axis=0)
+                temp_loss += loss.detach().float()
+                # argmax on device so only label indices are copied back to host
+                preds.append(logits.argmax(dim=-1))
 
         batch_iter.close()
-        temp_loss = temp_loss / total_sample_num
-        preds = np.argmax(preds, axis=-1)
+        temp_loss = temp_loss.item() / total_sample_num
+        preds = torch.cat(preds).cpu().numpy()
 
         return preds, temp_loss
 
@@ -357,24 +367,50 @@ class TaskRunner(object):
 
         return examples
 
+    def _load_features_by_task(self, task="train"):
+        examples = self._load_examples_by_task(task)
+        # convert examples to features
+        features = convert_examples_to_relation_extraction_features(
+            examples,
+            tokenizer=self.tokenizer,
+            max_length=self.args.max_seq_length,
+            label2idx=self.label2idx,
+            logger=self.args.logger)
+
+        return features
+
+    def _get_cache_dir(self, task="train"):
+        """
+            the cache key covers everything the features depend on:
+            the task data file content, tokenizer, max seq len, data format and label index
+        """
+        data_file = Path(self.data_processor.data_dir) / "{}.tsv".format(task)
+        data_hash = hashlib.sha1(data_file.read_bytes()).hexdigest() if data_file.exists() else ""
+        key = hashlib.sha1("{}|{}|{}|{}|{}|{}|{}|{}|{}".format(
+            data_hash, self.args.model_type, type(self.tokenizer).__name__, self.tokenizer.name_or_path,
+            self.args.do_lower_case,
+            self.args.max_seq_length, self.args.data_format_mode, self.args.data_file_header,
+            sorted(self.label2idx.items())).encode("utf-8")).hexdigest()
+
+        return Path(self.data_processor.data_dir) / "cached_{}_{}".format(task, key)
+
     def _check_cache(self, task="train"):
-        cached_examples_file = Path(self.args.data_dir) / "cached_{}_{}_{}_{}_{}.pkl".format(
-            self.args.model_type, self.args.data_format_mode, self.args.max_seq_length,
-            self.tokenizer.name_or_path.split("/")[-1], task)
-        # load examples from files or cache
-        if self.args.cache_data and cached_examples_file.exists():
-            examples = pkl_load(cached_examples_file)
-            self.args.logger.info("load {} data from cached file: {}".format(task, cached_examples_file))
-        elif self.args.cache_data and not cached_examples_file.exists():
-            self.args.logger.info(
-                "create {} examples...and will cache the processed data at {}".format(task, cached_examples_file))
-            examples = self._load_examples_by_task(task)
-            pkl_save(examples, cached_examples_file)
+        # load features from cache or tokenize examples from files
+        if not self.args.cache_data:
+            self.args.logger.info("create {} features...the processed data will not be cached".format(task))
+            return self._load_features_by_task(task)
+
+        cached_features_dir = self._get_cache_dir(task)
+        if has_cached_features(cached_features_dir):
+            features = load_features(cached_features_dir)
+            self.args.logger.info("load {} data from cached dir: {}".format(task, cached_features_dir))
         else:
-            self.args.logger.info("create training examples..."
-                                  "the processed data will not be cached")
-            examples = self._load_examples_by_task(task)
-        return examples
+            self.args.logger.info(
+                "create {} features...and will cache the processed data at {}".format(task, cached_features_dir))
+            features = self._load_features_by_task(task)
+            save_features(features, cached_features_dir)
+
+        return features
 
     def reset_dataloader(self, data_dir, has_file_header=None, max_len=None):
         """
@@ -391,31 +427,21 @@ class TaskRunner(object):
 
     def _init_dataloader(self):
         if self.args.do_train and self.train_data_loader is None:
-            train_examples = self._check_cache(task="train")
-            # convert examples to tensor
-            train_features = convert_examples_to_relation_extraction_features(
-                train_examples,
-                tokenizer=self.tokenizer,
-                max_length=self.args.max_seq_length,
-                label_list=self.label2idx,
-                output_mode="classification")
+            train_features = self._check_cache(task="train")
+            # the train rows read for the labels are not needed once the features exist
+            self.data_processor.release_train_lines()
 
             self.train_data_loader = relation_extraction_data_loader(
                 train_features,
                 batch_size=self.args.train_batch_size,
                 task="train",
                 logger=self.args.logger,
-                binary_mode=self.args.use_binary_classification_mode)
+                binary_mode=self.args.use_binary_classification_mode,
+                num_workers=self.args.num_workers,
+                dynamic_padding=self.args.use_dynamic_padding)
 
         if self.args.do_eval and self.dev_data_loader is None:
-            dev_examples = self._check_cache(task="dev")
-            # example2feature
-            dev_features = convert_examples_to_relation_extraction_features(
-                dev_examples,
-                tokenizer=self.tokenizer,
-                max_length=self.args.max_seq_length,
-                label_list=self.label2idx,
-                output_mode="classification")
+            dev_features = self._check_cache(task="dev")
             self.dev_features = dev_features
 
             self.dev_data_loader = relation_extraction_data_loader(
@@ -423,20 +449,17 @@ class TaskRunner(object):
                 batch_size=self.args.train_batch_size,
                 task="test",
                 logger=self.args.logger,
-                binary_mode=self.args.use_binary_classification_mode)
+                binary_mode=self.args.use_binary_classification_mode,
+                num_workers=self.args.num_workers,
+                dynamic_padding=self.args.use_dynamic_padding)
 
         if self.args.do_predict and self.test_data_loader is None:
-            test_examples = self._check_cache(task="test")
-            # example2feature
-            test_features = convert_examples_to_relation_extraction_features(
-                test_examples,
-                tokenizer=self.tokenizer,
-                max_length=self.args.max_seq_length,
-                label_list=self.label2idx,
-                output_mode="classification")
+            test_features = self._check_cache(task="test")
 
             self.test_data_loader = relation_extraction_data_loader(
                 test_features,
                 batch_size=self.args.eval_batch_size,
                 task="test", logger=self.args.logger,
-                binary_mode=self.args.use_binary_classification_mode)
+                binary_mode=self.args.use_binary_classification_mode,
+                num_workers=self.args.num_workers,
+                dynamic_padding=self.args.use_dynamic_padding)
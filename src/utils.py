@@ -1,7 +1,6 @@
 import logging
-from sklearn.metrics import accuracy_score
 import traceback
-from collections import defaultdict
+import numpy as np
 
 
 def try_catch_annotator(func):
@@ -52,15 +51,6 @@ class TransformerLogger:
         return self._create_logger("Transformer_Relation_Extraction")
 
 
-class PRF:
-    def __init__(self):
-        self.tp = 0
-        self.fp = 0
-
-    def __repr__(self):
-        return f"tp: {self.tp}; fp: {self.fp}"
-
-
 def calc(tp, tp_fp, tp_tn):
     if tp_fp != 0:
         pre = tp / tp_fp
@@ -82,28 +72,26 @@ def calc(tp, tp_fp, tp_tn):
 
 def measure_prf(preds, gs_labels, non_rel_label):
     res = dict()
-    temp = defaultdict(PRF)
     total_tp, total_tp_fp, total_tp_tn = 0, 0, 0
-    tn_dict = defaultdict(lambda: 0)
-
-    assert preds == gs_labels, "prediction and gold standard is not equal"
-
-    labels = set(gs_labels)
-    for l in labels:
-        for p, g in zip(preds, gs_labels):
-            if g == l:
-                tn_dict[l] += 1
-            if g == p == l:
-                temp[l].tp += 1
-            elif g != l and p == l:
-                temp[l].fp += 1
-
-    for l in labels:
-        if l == non_rel_label:
+
+    assert len(preds) == len(gs_labels), "prediction and gold standard is not equal"
+
+    # one confusion matrix (rows: gold; cols: prediction) gives tp, tp+fp and tp+fn for all labels
+    all_labels, label_ids = np.unique(np.concatenate([np.asarray(gs_labels), np.asarray(preds)]),
+                                      return_inverse=True)
+    num_labels = len(all_labels)
+    gs_ids, pred_ids = label_ids[:len(gs_labels)], label_ids[len(gs_labels):]
+    confusion = np.bincount(gs_ids * num_labels + pred_ids, minlength=num_labels * num_labels)\
+        .reshape(num_labels, num_labels)
+    tps = np.diag(confusion)
+    tp_fps = confusion.sum(axis=0)
+    tp_tns = confusion.sum(axis=1)
+
+    for i, l in enumerate(all_labels.tolist()):
+        # only labels in gold standard are measured
+        if l == non_rel_label or tp_tns[i] == 0:
             continue
-        tp, fp = temp[l].tp, temp[l].fp
-        tp_fp = tp + fp
-        tp_tn = tn_dict[l]
+        tp, tp_fp, tp_tn = int(tps[i]), int(tp_fps[i]), int(tp_tns[i])
         res[l] = calc(tp, tp_fp, tp_tn)
 
         total_tp += tp
@@ -117,7 +105,7 @@ def measure_prf(preds, gs_labels, non_rel_label):
 
 
 def acc_and_f1(labels, preds, label2idx, non_rel_label):
-    acc = accuracy_score(labels, preds)
+    acc = float(np.mean(np.asarray(labels) == np.asarray(preds)))
 
     idx2label = {v: k for k, v in label2idx.items()}
     new_labels = [idx2label[e] for e in labels]